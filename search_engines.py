@@ -1,68 +1,93 @@
 import pickle
 import os
+import sys
 from text_preprocessing import preprocess_text
 import math
 import heapq
+import operator
+import array
+from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+from numba import njit
+from pyroaring import BitMap
+
+
+# maps each additional field (used by the third search engine) to their position in the .tsv files
+field_to_idx = {
+    'booktitle' : 0,
+    'bookseries' : 1,
+    'bookauthors' : 2,
+    'publishingdate': 8,
+    'characters' : 9,
+    'setting' : 10
+}
+
+
+# suffixes of the .npy files of an inverted index in the CSR-like layout (see store_csr_inverted_idx), in the order they are loaded
+csr_suffixes = ['_term_ptr.npy', '_doc_ids.npy', '_tfidfs.npy', '_scales.npy']
 
 
 #--------------------------------------------------------STORING_DATA_FUNCTIONS------------------------------------------------------------------
 
 
 def create_inverted_idx(cwd, encoded_files_folder) -> None: 
-    """Creates and stores a dictionary which maps from encoded words to all the documents containing that word.
+    """Creates and stores a dictionary which maps from encoded words to all the documents containing that word, as a compressed (roaring) bitmap.
        Stores the output in a .pickle file and returns None.
 
     Args:
         cwd (str): Current working directory
         encoded_files_folder (str): subfolder where the encoded plots are stored
     """
-    inverted_idx = {}
-
-    # sorts the files in numerical order (to avoid reading in this order 1 -> 10 -> 100)
-    file_list = os.listdir(cwd+encoded_files_folder)
-    file_list = sorted(file_list, key=lambda x:int(os.path.splitext(x)[0]))
+    docs_buffers = defaultdict(lambda: array.array('I'))
     
-    # iterates over each word in each document. Inserts key-value pairs in the inverted_idx, where the key is a word (encoded) and the value is a list of all documents containing the word  
-    for file_name in file_list:
-        with open(cwd+encoded_files_folder + file_name,'rb') as f:
-            dict_repr = pickle.load(f)
-            for key in dict_repr:
-                inverted_idx.setdefault(key, []).append(int(file_name[:-7]))
+    # iterates over each word in each document. Appends the document to a typed buffer per word (encoded)
+    for doc, path in get_encoded_files(cwd, encoded_files_folder):
+        dict_repr = load_encoded_file(path)
+        for key in dict_repr:
+            docs_buffers[key].append(doc)
+    
+    # converts each buffer of documents into a bitmap (directly from its memory), compressing the runs of consecutive documents
+    inverted_idx = {}
+    for key in docs_buffers:
+        inverted_idx[key] = BitMap(docs_buffers[key])
+        inverted_idx[key].run_optimize()
     
     with open('inverted_idx.pickle', "wb") as g:
-        pickle.dump(inverted_idx, g)
+        pickle.dump(inverted_idx, g, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def create_inverted_idx_2(cwd, encoded_files_folder) -> None:
-    """Creates and stores a dictionary which maps from encoded words to all the documents containing that word + the corresponding tfidf score.
+    """Creates and stores a dictionary which maps from encoded words to a tuple of two numpy arrays:
+       all the documents containing that word (int32) and the corresponding tfidf scores (float32).
        Stores the output in a .pickle file and returns None.
 
     Args:
         cwd (str): Current working directory
         encoded_files_folder (str): subfolder where the encoded plots are stored
     """
-    inverted_idx2 = {}
-
-    #sorts the files in numerical order (to avoid reading in this order 1 -> 10 -> 100)
-    file_list = os.listdir(cwd+encoded_files_folder)
-    file_list = sorted(file_list, key=lambda x:int(os.path.splitext(x)[0]))
+    docs_buffers = defaultdict(lambda: array.array('i'))
+    tfs_buffers = defaultdict(lambda: array.array('f'))
     
-    # iterates over each word in each document. Inserts key-value pairs in the inverted_idx2, where the key is a word (encoded) and the value is a list of tuples of this format (doc_name, term frequency) 
+    # iterates over each word in each document. Appends the document and the term frequency to two parallel typed buffers per word (encoded)
     docs_count = 0
-    for file_name in file_list:
+    for doc, path in get_encoded_files(cwd, encoded_files_folder):
         docs_count += 1
-        with open(cwd+encoded_files_folder + file_name,'rb') as f:
-            dict_repr = pickle.load(f)
-            for key in dict_repr:
-                inverted_idx2.setdefault(key, []).append((int(file_name[:-7]), dict_repr[key]))
+        dict_repr = load_encoded_file(path)
+        for key in dict_repr:
+            docs_buffers[key].append(doc)
+            tfs_buffers[key].append(dict_repr[key])
     
-    # iterates over each word in the dict and substitutes the term frequency with the term frequency multiplied by the inverse document frequency
-    for key in inverted_idx2:
-        for idx, value in enumerate(inverted_idx2[key]):
-            inverted_idx2[key][idx] = (value[0], value[1] * math.log(docs_count / len(inverted_idx2[key])))
+    # converts the buffers into numpy arrays and multiplies all the term frequencies of a word by its inverse document frequency in a single vectorized operation
+    inverted_idx2 = {}
+    for key in docs_buffers:
+        docs = np.asarray(docs_buffers[key], dtype=np.int32)
+        tfidfs = np.asarray(tfs_buffers[key], dtype=np.float32)
+        tfidfs *= math.log(docs_count / docs.size)
+        inverted_idx2[key] = (docs, tfidfs)
     
     with open('inverted_idx2.pickle', "wb") as g:
-        pickle.dump(inverted_idx2, g)
+        pickle.dump(inverted_idx2, g, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def store_squared_tfidf_per_document(inverted_idx2) -> None:
@@ -72,24 +97,279 @@ def store_squared_tfidf_per_document(inverted_idx2) -> None:
     Args:
         inverted_idx2 (dict): the inverted index with tfidf scores
     """
-    squared_tfidfs = {}
+    squared_tfidfs = compute_squared_tfidf_per_document(inverted_idx2)
     
-    # iterates over each value and each key of the inverted_idx2, updates the squared_tfidfs per document
+    with open('squared_tfidf_per_document.pickle', "wb") as g:
+        pickle.dump(squared_tfidfs, g, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def store_normalized_inverted_idx2(inverted_idx2) -> None:
+    """Divides every tfidf score of the inverted_idx2 by the sqrt(|d|) of its document and stores the normalized index
+       in the CSR-like layout (see store_csr_inverted_idx), so that at query time the cosine similarity reduces to a dot product.
+       This is the index used by the second and third search engines.
+
+    Args:
+        inverted_idx2 (dict): the inverted index with tfidf scores
+    """
+    sqrt_squared_tfidf = get_sqrt_squared_tfidf(compute_squared_tfidf_per_document(inverted_idx2))
+    
+    # divides the tfidf scores of each word by the sqrt(|d|) of the corresponding documents
+    normalized_inverted_idx2 = {}
     for term in inverted_idx2:
-        for doc, tfidf in inverted_idx2[term]:
-            squared_tfidfs.setdefault(doc, []).append(tfidf**2)
+        docs, tfidfs = inverted_idx2[term]
+        normalized_inverted_idx2[term] = (docs, tfidfs / sqrt_squared_tfidf[docs])
     
-    #sums the squared tfidfs
-    for doc in squared_tfidfs:
-        squared_tfidfs[doc] = sum(squared_tfidfs[doc])
+    store_csr_inverted_idx(normalized_inverted_idx2, 'normalized_inverted_idx2')
+
+
+def store_csr_inverted_idx(inverted_idx2, name) -> None:
+    """Flattens an inverted index with tfidf scores in a CSR-like layout of contiguous arrays and stores each of them in a .npy file:
+       term_ptr (int64), doc_ids (int32) and tfidfs, where the documents of the word t (and their scores)
+       are doc_ids[term_ptr[t]:term_ptr[t+1]] (and tfidfs[term_ptr[t]:term_ptr[t+1]]).
+       The tfidf scores are only used for ranking, so they are quantized to uint16 after dividing them by the max score of their word,
+       which is stored in a fourth array (scales, float32) indexed by word.
+
+    Args:
+        inverted_idx2 (dict): the inverted index with tfidf scores
+        name (str): prefix of the .npy files
+    """
+    terms = sorted(inverted_idx2)
     
-    with open('squared_tfidf_per_document.pickle', "wb") as g:
-        pickle.dump(squared_tfidfs,g)
+    # words that do not appear in the index get an empty slice (and a scale of 0)
+    lengths = np.zeros(terms[-1] + 1, dtype=np.int64)
+    scales = np.zeros(terms[-1] + 1, dtype=np.float32)
+    for term in terms:
+        lengths[term] = inverted_idx2[term][0].size
+        scales[term] = inverted_idx2[term][1].max()
+    
+    term_ptr = np.concatenate(([0], np.cumsum(lengths)))
+    doc_ids = np.concatenate([inverted_idx2[term][0] for term in terms]).astype(np.int32)
+    tfidfs = np.concatenate([inverted_idx2[term][1] for term in terms]).astype(np.float32)
+    
+    # maps each score in [0, max score of its word] to [0, 65535] (words with a max score of 0, e.g. in every document, stay at 0)
+    postings_scales = np.repeat(scales, lengths)
+    normalized = np.divide(tfidfs, postings_scales, out=np.zeros_like(tfidfs), where=postings_scales > 0)
+    quantized = np.round(normalized * np.iinfo(np.uint16).max).astype(np.uint16)
+    
+    for suffix, array_to_save in zip(csr_suffixes, [term_ptr, doc_ids, quantized, scales]):
+        np.save(name + suffix, array_to_save)
+
+
+def store_articles(cwd, tsv_folder) -> None:
+    """Parses all the .tsv files once and stores two dictionaries in .pickle files:
+       one that maps from each document to the tuple of all its fields (used to print the results),
+       and one inverted index per additional field (see field_to_idx), that maps from each pre-processed word of the field
+       to the set of documents containing it (used by the third search engine).
+
+    Args:
+        cwd (str): Current working directory
+        tsv_folder (str): subfolder where the .tsv files are stored
+    """
+    articles = {}
+    fields_inverted_idx = {field: {} for field in field_to_idx}
+
+    for file_name in os.listdir(cwd+tsv_folder):
+        doc = int(file_name[8:-4])
+        with open(cwd+tsv_folder+file_name, 'r', encoding = 'utf-8') as f:
+            all_fields = f.readlines()[2].split('\t')
+        
+        articles[doc] = tuple(all_fields)
+        for field, idx in field_to_idx.items():
+            for token in preprocess_text(all_fields[idx]):
+                fields_inverted_idx[field].setdefault(token, set()).add(doc)
+    
+    with open('articles.pickle', "wb") as g:
+        pickle.dump(articles, g, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    with open('fields_inverted_idx.pickle', "wb") as g:
+        pickle.dump(fields_inverted_idx, g, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 #------------------------------------------------------------HELPER FUNCTIONS----------------------------------------------------------
 
 
+def load_inverted_idx(file_name):
+    """Loads the inverted index stored by create_inverted_idx.
+       Indexes stored in the older format (a list of documents per word) are converted to bitmaps on load.
+
+    Args:
+        file_name (str): name of the .pickle file
+
+    Returns:
+        [dict]: a mapping between encoded words (integers) and the bitmap of the documents that contain the word
+    """
+    with open(file_name, 'rb') as h:
+        inverted_idx = pickle.load(h)
+    
+    for key, docs in inverted_idx.items():
+        if isinstance(docs, list):
+            inverted_idx[key] = BitMap(array.array('I', docs))
+            inverted_idx[key].run_optimize()
+    return inverted_idx
+
+
+def load_inverted_idx2(file_name):
+    """Loads the inverted index with tfidf scores stored by create_inverted_idx_2.
+       Indexes stored in the older format (a list of (document, tfidf) tuples per word) are converted to the tuple of two numpy arrays on load.
+
+    Args:
+        file_name (str): name of the .pickle file
+
+    Returns:
+        [dict]: a mapping between encoded words (integers) and the arrays of documents that contain the word + their tfidf scores
+    """
+    with open(file_name, 'rb') as h:
+        inverted_idx2 = pickle.load(h)
+    
+    for key, postings in inverted_idx2.items():
+        if isinstance(postings, list):
+            docs, tfidfs = zip(*postings)
+            inverted_idx2[key] = (np.array(docs, dtype=np.int32), np.array(tfidfs, dtype=np.float32))
+    return inverted_idx2
+
+
+def load_csr_inverted_idx(name):
+    """Loads an inverted index stored by store_csr_inverted_idx, memory-mapping the .npy files (no copy at startup).
+       The arrays are returned as plain ndarray views of the maps, so that they can be passed to merge_and.
+
+    Args:
+        name (str): prefix of the .npy files
+
+    Returns:
+        [tuple]: the four arrays (term_ptr, doc_ids, tfidfs, scales)
+    """
+    return tuple(np.asarray(np.load(name + suffix, mmap_mode='r')) for suffix in csr_suffixes)
+
+
+def csr_inverted_idx_exists(name):
+    """Checks that all the .npy files of an inverted index stored by store_csr_inverted_idx exist
+       (a build that stopped halfway leaves only some of them)
+
+    Args:
+        name (str): prefix of the .npy files
+
+    Returns:
+        [bool]: True if all the files exist
+    """
+    return all(os.path.exists(name + suffix) for suffix in csr_suffixes)
+
+
+@njit(cache=True)
+def gallop(doc_ids, start, end, target):
+    """Compiled (numba) exponential search: finds the first position in doc_ids[start:end] (sorted) whose document is >= target.
+       The step doubles until it jumps past the target, then a binary search runs only in the last step,
+       so the cost depends on the distance from start rather than on the length of the list.
+
+    Args:
+        doc_ids (numpy.ndarray): the documents of all the postings (sorted within each word)
+        start (int): first position to look at
+        end (int): end of the postings of the word
+        target (int): the document to look for
+
+    Returns:
+        [int]: the first position whose document is >= target (end if there is none)
+    """
+    if start >= end or doc_ids[start] >= target:
+        return start
+    
+    # doc_ids[low] is always < target
+    low = start
+    step = 1
+    while low + step < end and doc_ids[low + step] < target:
+        low += step
+        step *= 2
+    high = min(low + step, end)
+    
+    return low + 1 + np.searchsorted(doc_ids[low + 1:high], target)
+
+
+@njit(cache=True)
+def merge_and(term_ptr, doc_ids, tfidfs, terms, weights):
+    """Compiled (numba) merge of the posting lists of some words, in the CSR-like layout:
+       takes each document of the shortest list and looks for it in the other lists (from the shortest to the longest) with an exponential search,
+       so that merging a short list with a long one costs O(short * log(long)) instead of O(long).
+
+    Args:
+        term_ptr (numpy.ndarray): start of the postings of each word
+        doc_ids (numpy.ndarray): the documents of all the postings (sorted within each word)
+        tfidfs (numpy.ndarray): the (quantized) tfidf scores of all the postings
+        terms (numpy.ndarray): the words to merge, encoded in integer
+        weights (numpy.ndarray): the weight of each word, multiplied by its scores
+
+    Returns:
+        [tuple]: two numpy arrays, the documents that appear in every list and the sum of their weighted scores
+    """
+    n = terms.size
+    ptrs = np.empty(n, dtype=np.int64)
+    ends = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        ptrs[i] = term_ptr[terms[i]]
+        ends[i] = term_ptr[terms[i] + 1]
+    
+    # sorts the lists from the shortest to the longest, the result cannot be longer than the shortest one
+    order = np.argsort(ends - ptrs)
+    shortest = order[0]
+    result_docs = np.empty(ends[shortest] - ptrs[shortest], dtype=np.int32)
+    result_scores = np.empty(ends[shortest] - ptrs[shortest], dtype=np.float32)
+    count = 0
+    
+    for position in range(ptrs[shortest], ends[shortest]):
+        doc = doc_ids[position]
+        score = tfidfs[position] * weights[shortest]
+        found = True
+        
+        # the pointers only move forward, since the documents of the shortest list are sorted
+        for i in order[1:]:
+            ptrs[i] = gallop(doc_ids, ptrs[i], ends[i], doc)
+            
+            # stops as soon as any pointer surpasses the last element of its list
+            if ptrs[i] == ends[i]:
+                return result_docs[:count], result_scores[:count]
+            
+            if doc_ids[ptrs[i]] != doc:
+                found = False
+                break
+            score += tfidfs[ptrs[i]] * weights[i]
+        
+        # the document is in every list -> add the document and its score to the result
+        if found:
+            result_docs[count] = doc
+            result_scores[count] = score
+            count += 1
+    
+    return result_docs[:count], result_scores[:count]
+
+
+def get_encoded_files(cwd, encoded_files_folder):
+    """Scans the folder of the encoded plots and returns the (document number, path) of each file,
+       sorted in numerical order (to avoid reading in this order 1 -> 10 -> 100)
+
+    Args:
+        cwd (str): Current working directory
+        encoded_files_folder (str): subfolder where the encoded plots are stored
+
+    Returns:
+        [list]: a sorted list of tuples of this format (document number, path)
+    """
+    with os.scandir(cwd+encoded_files_folder) as entries:
+        encoded_files = [(int(entry.name.split('.')[0]), entry.path) for entry in entries]
+    encoded_files.sort()
+    return encoded_files
+
+
+def load_encoded_file(path):
+    """Loads an encoded plot, reading the whole file with a single large buffered read
+
+    Args:
+        path (str): path of the encoded plot
+
+    Returns:
+        [dict]: a mapping from encoded words to their term frequency in the plot
+    """
+    with open(path, 'rb', buffering=1 << 20) as f:
+        return pickle.load(f)
+
+
 def encode_query(query, vocabulary):
     """Takes a textual query and a vocabulary (mapping from words to integers), returns the encoded query in a list.
        If a word is not in the dictionary, the function returns False.
@@ -101,17 +381,30 @@ def encode_query(query, vocabulary):
     Returns:
         [list or bool]: the encoded query in a list or False
     """
-    encoded = []
-    for token in query:
-        if token in vocabulary:
-            encoded.append(vocabulary[token])
-        else:
-            return False
-    return encoded
+    # a single lookup per token, the first missing token stops the encoding
+    try:
+        return [vocabulary[token] for token in query]
+    except KeyError:
+        return False
+
+
+@lru_cache(maxsize=1024)
+def preprocess_query(query):
+    """Pre-processes a text typed by the user (a query or the value of an additional field) with preprocess_text.
+       The results are cached, so the same text is processed only once per session.
+       Only meant for the query path: the plots and the .tsv fields are pre-processed once at build time, without cache
+
+    Args:
+        query (str): a text typed by the user
+
+    Returns:
+        [tuple]: the pre-processed text
+    """
+    return tuple(preprocess_text(query))
 
 
 def get_top_k(dic, k):
-    """get top k items of a dictionary by value using heaps.
+    """get top k items of a dictionary by value using heaps (ties are broken by the lowest key).
 
     Args:
         dic (dict): a dictionary
@@ -119,79 +412,151 @@ def get_top_k(dic, k):
     Returns:
         [type]: a list of the top k dict items by value 
     """
-    # convert the dictionary into a list of tuples, swapping key-values
-    heap = [(-value, key) for key,value in dic.items()] # we temporarily invert the values sign because heapq implements only a min heap
-    largest = heapq.nsmallest(k, heap)
+    # nlargest is stable, so sorting the items by key first keeps the lowest keys among the ties
+    return heapq.nlargest(k, sorted(dic.items()), key=operator.itemgetter(1))
+
+
+def get_top_k_from_arrays(keys, values, k):
+    """get top k (key, value) pairs of two parallel numpy arrays by value, using a partial sort (ties are broken by the lowest key).
+
+    Args:
+        keys (numpy.ndarray): the keys (e.g. documents)
+        values (numpy.ndarray): the values (e.g. similarity scores)
+        k (int): number of output items
+
+    Returns:
+        [list]: a list of the top k (key, value) pairs by value
+    """
+    # finds the k-th largest value in linear time and keeps every item with a value at least as large (including all the ties),
+    # then sorts only these items by value (descending) and key (ascending)
+    if values.size > k:
+        kth_value = np.partition(values, -k)[-k]
+        top = np.flatnonzero(values >= kth_value)
+    else:
+        top = np.arange(values.size)
+    top = top[np.lexsort((keys[top], -values[top]))][:k]
+    
+    return list(zip(keys[top].tolist(), values[top].tolist()))
+
+
+def compute_squared_tfidf_per_document(inverted_idx2):
+    """Computes the sum of the squared tfidf scores of each document ( |d| in the cosine similarity formula )
+
+    Args:
+        inverted_idx2 (dict): the inverted index with tfidf scores
+
+    Returns:
+        [dict]: a dict with documents as keys, and the sum of their squared tfidf scores as values
+    """
+    squared_tfidfs = {}
+    
+    # iterates over each value and each key of the inverted_idx2, updates the squared_tfidfs per document
+    for term in inverted_idx2:
+        docs, tfidfs = inverted_idx2[term]
+        for doc, tfidf in zip(docs.tolist(), tfidfs.tolist()):
+            squared_tfidfs.setdefault(doc, []).append(tfidf**2)
+    
+    #sums the squared tfidfs
+    for doc in squared_tfidfs:
+        squared_tfidfs[doc] = sum(squared_tfidfs[doc])
     
-    # swap back key-values and values sign
-    return [(key, -value) for value, key in largest]
+    return squared_tfidfs
+
+
+def get_sqrt_squared_tfidf(squared_tfidf_per_document):
+    """Takes the sum of the squared tfidf scores of each document and returns their square roots (sqrt(|d|) in the cosine similarity formula)
+       in a numpy array, where the position of each value is the document number.
+
+    Args:
+        squared_tfidf_per_document (dict): a dict with documents as keys, and the sum of their squared tfidf scores for ALL their words
+
+    Returns:
+        [numpy.ndarray]: sqrt(|d|) for each document, indexed by document number
+    """
+    sqrt_squared_tfidf = np.zeros(max(squared_tfidf_per_document) + 1, dtype=np.float32)
+    docs = np.fromiter(squared_tfidf_per_document.keys(), dtype=np.int32, count=len(squared_tfidf_per_document))
+    sqrt_squared_tfidf[docs] = np.sqrt(np.fromiter(squared_tfidf_per_document.values(), dtype=np.float32, count=len(squared_tfidf_per_document)))
+    return sqrt_squared_tfidf
 
 
-def compute_cosine_similarity(encoded_query, docs_scores, squared_tfidf_per_document) -> dict:
+def compute_cosine_similarity(encoded_query, doc_ids, docs_scores) -> tuple:
     """Compares a textual query with some documents (which contain all the words in the query)
        and computes for each pair their cosine similarity.
-       We assume that each term of the query has always a score of 1
+       We assume that each term of the query has always a score of 1, and that the tfidf scores
+       of the documents are already divided by their sqrt(|d|) (see store_normalized_inverted_idx2)
 
     Args:
         encoded_query (list): a textual query, encoded in integers
-        docs_scores (dict): a dict with documents as keys, and the sum of their tfidf scores for ONLY the words in the query as values
-        squared_tfidf_per_document (dict): a dict with documents as keys, and the sum of their squared tfidf scores for ALL their words
+        doc_ids (numpy.ndarray): the documents
+        docs_scores (numpy.ndarray): the sum of the normalized tfidf scores of each document for ONLY the words in the query
 
     Returns:
-        [dict]: a dict with documents as keys, and their cosine similarity with respect to the query as values
+        [tuple]: two parallel numpy arrays, the documents and their cosine similarity with respect to the query
     """
-    similarity_scores = {}
-    
-    for doc in docs_scores:
-        cos_similarity = docs_scores[doc] / ((math.sqrt(squared_tfidf_per_document[doc]))*(math.sqrt(len(encoded_query)))) 
-        similarity_scores[doc] = cos_similarity
+    # the only part of the denominator left is the query length, which is the same for every document
+    similarities = docs_scores / math.sqrt(len(encoded_query))
     
-    return similarity_scores
+    return doc_ids, similarities
 
 
 #------------------------------------------------------------PRINT FUNCTIONS-----------------------------------------------------------
 
 
-def print_search_engine_result(result):
+def print_search_engine_result(result, articles):
     """Prints the first search engine results,
-       Fetching the data from tsv files.
+       Fetching the data from the parsed articles. The whole output is written at once.
 
     Args:
         result (list): a list of all the documents selected by the search engine
+        articles (dict): a mapping between each document and the tuple of its fields (see store_articles)
     """
+    chunks = []
     for book in result:
-        with open(os.getcwd()+'\\tsvs\\'+'article_'+str(book)+'.tsv', 'r', encoding = 'utf-8') as f:
-            all_fields = f.readlines()[2].split('\t')
-            print("")
-            print('--BOOKTITLE--')
-            print(all_fields[0] + '\n')
-            print('--PLOT--')
-            print(all_fields[6] + '\n')
-            print('--URL--')
-            print(all_fields[-1] + '\n')
-            print('----------------------------------------------------------------------------------------------' + '\n')
+        all_fields = articles[book]
+        chunks.append(f"""
+--BOOKTITLE--
+{all_fields[0]}
+
+--PLOT--
+{all_fields[6]}
+
+--URL--
+{all_fields[-1]}
+
+----------------------------------------------------------------------------------------------
+
+""")
+    sys.stdout.write(''.join(chunks))
     
 
-def print_search_engine_2_result(result):
+def print_search_engine_2_result(result, articles):
     """Prints the second search engine results,
-       Fetching the data from tsv files.
+       Fetching the data from the parsed articles. The whole output is written at once.
 
     Args:
         result (dict): a dict of all the documents selected by the search engine and their similarity score
+        articles (dict): a mapping between each document and the tuple of its fields (see store_articles)
     """    
+    chunks = []
     for book, score in result:
-        with open(os.getcwd()+'\\tsvs\\'+'article_'+str(book)+'.tsv', 'r', encoding = 'utf-8') as f:
-            all_fields = f.readlines()[2].split('\t')
-            print("")
-            print('--BOOKTITLE--')
-            print(all_fields[0] + '\n')
-            print('--PLOT--')
-            print(all_fields[6] + '\n')
-            print('--URL--')
-            print(all_fields[-1] + '\n')
-            print('--SIMILARITY--')
-            print(round(score,2), '\n')
-            print('----------------------------------------------------------------------------------------------' + '\n')
+        all_fields = articles[book]
+        chunks.append(f"""
+--BOOKTITLE--
+{all_fields[0]}
+
+--PLOT--
+{all_fields[6]}
+
+--URL--
+{all_fields[-1]}
+
+--SIMILARITY--
+{round(score,2)} 
+
+----------------------------------------------------------------------------------------------
+
+""")
+    sys.stdout.write(''.join(chunks))
 
 
 #------------------------------------------------------------SEARCH ENGINES---------------------------------------------------------------
@@ -203,7 +568,7 @@ def search_engine(encoded_query, inverted_idx):
 
     Args:
         encoded_query (list): a textual query, encoded in integer
-        inverted_idx (dict): a mapping between encoded words (integers) and the documents that contain the word
+        inverted_idx (dict): a mapping between encoded words (integers) and the bitmap of the documents that contain the word
 
     Returns:
         [list]: a list of the documents that contain all the tokens in the query
@@ -213,117 +578,63 @@ def search_engine(encoded_query, inverted_idx):
     if not encoded_query:
         return result
     else:  
-        # selects only the list corresponding to the words that appear in the query
-        selected_lists = [inverted_idx[token] for token in encoded_query]
-
-        idx = [0] * len(selected_lists) # start at index 0 for each list
-        lists_len = [len(my_list) for my_list in selected_lists]
-        selected_lists2 = list(enumerate(selected_lists))
-
-        # checks if any list index surpasses the last element
-        while all([k < m for k, m in zip(idx, lists_len)]):
-            max_num = max([docs[idx[list_num]] for list_num, docs in selected_lists2]) # get the max document number
-            
-            # handles the case when each list is pointing at the same value
-            if all([docs[idx[list_num]] == max_num for list_num, docs in selected_lists2]):
-                result.append(max_num)
-                idx = [i+1 for i in idx]
-            
-            # handles all the other cases, increasing idx on all lists that are not pointing at the max value
-            else:
-                j = 0
-                for my_list in selected_lists:
-                    if my_list[idx[j]] == max_num:
-                        pass
-                    else:
-                        idx[j] += 1
-                    j += 1
-        
-        return result
+        # intersects the bitmaps corresponding to the words that appear in the query
+        return list(BitMap.intersection(*[inverted_idx[token] for token in encoded_query]))
 
 
-def search_engine_2(encoded_query, inverted_idx2, squared_tfidf_per_document, k):
-    """takes an encoded query the inverted_idx and the squared_tfidf per document,
+def search_engine_2(encoded_query, inverted_idx2, k):
+    """takes an encoded query and the normalized inverted_idx2,
        searches in the inverted_idx2 and returns the top k documents that are most
        similar to the query (and contain all tokens in the query).
 
     Args:
         encoded_query (list): a textual query, encoded in integer
-        inverted_idx2 (dict):  a mapping between encoded words (integers) and the documents that contain the word + their tfidf score
-        squared_tfidf_per_document (dict): a mapping between each document and the the sum of its squared tfidf scores for each word
+        inverted_idx2 (tuple):  the arrays (term_ptr, doc_ids, tfidfs, scales) of the inverted index, with the tfidf scores divided by sqrt(|d|) (see load_csr_inverted_idx)
         k (int): number of output documents
 
     Returns:
         [dict]: a dictionary of the top k documents that are most similar to the query
     """
     result = []
-    docs_scores = {}
     
     if not encoded_query:
         return result
     else:
-        # selects only the list corresponding to the words that appear in the query 
-        selected_lists = [inverted_idx2[token] for token in encoded_query]
+        term_ptr, doc_ids, tfidfs, scales = inverted_idx2
         
-        idx = [0] * len(selected_lists) # start at index 0 for each list
-        lists_len = [len(my_list) for my_list in selected_lists]
-        selected_lists2 = list(enumerate(selected_lists)) # enumerate each of our lists
+        # the weight of each word of the query converts back its quantized scores
+        terms = np.asarray(encoded_query, dtype=np.int64)
+        weights = (scales[terms] / np.iinfo(np.uint16).max).astype(np.float32)
         
-        # checks if any list idx surpasses the last element
-        while all([k < m for k, m in zip(idx, lists_len)]):
-            max_num = max([docs[idx[list_num]][0] for list_num, docs in selected_lists2])  # get the max document number between the selected ones
-            
-            # handles the case when each list is pointing at the same value -> add the document and its score to the result
-            if all([docs[idx[list_num]][0] == max_num for list_num, docs in selected_lists2]):
-                docs_scores[max_num] = sum([docs[idx[list_num]][1] for list_num, docs in selected_lists2])
-                idx = [i+1 for i in idx]
-            
-            # handles all the other cases, increasing idx on all lists that are not pointing at the max value
-            else:
-                j = 0
-                for my_list in selected_lists:
-                    if my_list[idx[j]][0] == max_num:
-                        pass
-                    else:
-                        idx[j] += 1
-                    j += 1
+        # selects the documents that contain all the words in the query, with the sum of their tfidf scores
+        doc_ids, docs_scores = merge_and(term_ptr, doc_ids, tfidfs, terms, weights)
         
         # computes the cosine similarity for each of the selected docs
-        all_scores = compute_cosine_similarity(encoded_query, docs_scores, squared_tfidf_per_document)
+        doc_ids, similarities = compute_cosine_similarity(encoded_query, doc_ids, docs_scores)
         
-        # returns the top k documents ordered by cos similarity (using heaps)
-        return get_top_k(all_scores, k)
+        # returns the top k documents ordered by cos similarity
+        return get_top_k_from_arrays(doc_ids, similarities, k)
 
 
-def search_engine_3(encoded_query, inverted_idx2, squared_tfidf_per_document, uncoded_query):
+def search_engine_3(encoded_query, inverted_idx2, uncoded_query, fields_inverted_idx):
     """Uses search engine 2 to get the top 10 documents with with highest similarity to the query,
        then prompts the user to specify new info, related to the other book fields (e.g. bookTitle, setting, etc.),
        adjusts the score based on the new info and returns the top 3 books according to the new score
     Args:
         encoded_query (list): a textual query, encoded in integer
-        inverted_idx2 (dict): the inverted index with tfidf scores
-        squared_tfidf_per_document (dict): |d| of the cosine similarity formula (before sqrt) 
-        uncoded_query (list): the same textual query, not encoded in integers
+        inverted_idx2 (tuple): the inverted index with tfidf scores divided by sqrt(|d|), in the CSR-like layout
+        uncoded_query (tuple): the same textual query, not encoded in integers (see preprocess_query)
+        fields_inverted_idx (dict): a mapping between each additional field and its inverted index (pre-processed word -> set of documents, see store_articles)
 
     Returns:
         [dic]: the top k documents ranked by the new adjusted score
     """
     
     # apply the second search engine (plot only)
-    plot_result = search_engine_2(encoded_query, inverted_idx2, squared_tfidf_per_document, 10)
+    plot_result = search_engine_2(encoded_query, inverted_idx2, 10)
 
     additional_info = []
 
-    # maps each additional field to their position in the .tsv files
-    field_to_idx = {
-        'booktitle' : 0,
-        'bookseries' : 1,
-        'bookauthors' : 2,
-        'publishingdate': 8,
-        'characters' : 9,
-        'setting' : 10
-    }
-
     # prompts the user to insert additional information
     while True:
         try:
@@ -334,8 +645,10 @@ def search_engine_3(encoded_query, inverted_idx2, squared_tfidf_per_document, un
             
             info = info.split(':')
 
+            # stores the documents whose field contains any word of the value
             if info[0] in field_to_idx:
-                additional_info.append(info)
+                field_idx = fields_inverted_idx[info[0]]
+                additional_info.append(set().union(*[field_idx.get(token, set()) for token in preprocess_query(info[1])]))
             else:
                 print('field not found, please try again\n')
 
@@ -348,14 +661,10 @@ def search_engine_3(encoded_query, inverted_idx2, squared_tfidf_per_document, un
     for doc, score in plot_result:
         total_score = score
         
-        with open('.\\tsvs\\article_'+str(doc)+'.tsv', 'r', encoding = 'utf-8') as f:
-            all_fields = f.readlines()[2].split('\t')
-            all_fields = [preprocess_text(field) for field in all_fields]     
-            
-            # iterates over each additional info and if it matches, adjusts the score
-            for item in additional_info:
-                if item[1] in all_fields[field_to_idx[item[0]]]:
-                    total_score += total_score * 1/2
+        # iterates over each additional info and if it matches, adjusts the score
+        for matching_docs in additional_info:
+            if doc in matching_docs:
+                total_score += total_score * 1/2
         
         # final score for each document
         final_score[doc] = total_score
@@ -377,26 +686,35 @@ if __name__ == "__main__":
     #create_inverted_idx(cwd, encoded_files_folder)
     #create_inverted_idx_2(cwd, encoded_files_folder)
 
-    with open('inverted_idx.pickle', 'rb') as h:
-        inverted_idx = pickle.load(h)
+    inverted_idx = load_inverted_idx('inverted_idx.pickle')
     
-    with open('inverted_idx2.pickle', 'rb') as h:
-        inverted_idx2 = pickle.load(h)
+    # builds the normalized index used by the second and third search engines the first time (see the README)
+    if not csr_inverted_idx_exists('normalized_inverted_idx2'):
+        print('normalized_inverted_idx2_*.npy not found, building the normalized index from inverted_idx2.pickle...')
+        store_normalized_inverted_idx2(load_inverted_idx2('inverted_idx2.pickle'))
+
+    inverted_idx2 = load_csr_inverted_idx('normalized_inverted_idx2')
     
     with open('vocabulary.pickle', 'rb') as q:
         vocabulary = pickle.load(q)
 
-    #store_squared_tfidf_per_document(inverted_idx2)
-    
-    with open('squared_tfidf_per_document.pickle', "rb") as q:
-        squared_tfidf_per_document = pickle.load(q)
+    # parses the .tsv files and builds the inverted indexes of the additional fields the first time (see the README)
+    if not os.path.exists('articles.pickle') or not os.path.exists('fields_inverted_idx.pickle'):
+        print('articles.pickle or fields_inverted_idx.pickle not found, parsing all the .tsv files and pre-processing their fields (this can take a long time)...')
+        store_articles(cwd, "\\tsvs\\")
+
+    with open('articles.pickle', 'rb') as q:
+        articles = pickle.load(q)
+
+    with open('fields_inverted_idx.pickle', 'rb') as q:
+        fields_inverted_idx = pickle.load(q)
 
 
     query = input('enter your query:\n')
-    preprocessed_query = preprocess_text(query)
+    preprocessed_query = preprocess_query(query)
     encoded_query = encode_query(preprocessed_query, vocabulary)
     
-    print_search_engine_result(search_engine(encoded_query, inverted_idx))
-    print_search_engine_2_result(search_engine_2(encoded_query, inverted_idx2, squared_tfidf_per_document, 5))
-    print_search_engine_2_result(search_engine_3(encoded_query, inverted_idx2, squared_tfidf_per_document, preprocessed_query))
+    print_search_engine_result(search_engine(encoded_query, inverted_idx), articles)
+    print_search_engine_2_result(search_engine_2(encoded_query, inverted_idx2, 5), articles)
+    print_search_engine_2_result(search_engine_3(encoded_query, inverted_idx2, preprocessed_query, fields_inverted_idx), articles)
     
@@ -8,6 +8,7 @@ from nltk.stem import WordNetLemmatizer
 from nltk.corpus import wordnet
 import os
 import pickle
+from functools import lru_cache
 
 
 def get_plot_from_tsv(file_name):
@@ -42,8 +43,15 @@ def tokenize_text(text):
     return tokenizer.tokenize(text)
 
 
+@lru_cache(maxsize=None)
+def get_stopwords():
+    """Loads the stopwords only once per session, as a set"""
+    return frozenset(stopwords.words())
+
+
 def remove_stopwords(tokenized_text):
-    return [word for word in tokenized_text if not word in stopwords.words()]
+    stop_words = get_stopwords()
+    return [word for word in tokenized_text if not word in stop_words]
 
 
 def lemmatize_text(tokenized_text):
@@ -110,7 +118,7 @@ def save_vocabulary(vocabulary):
         vocabulary (dict): mapping from word to integers
     """
     with open('vocabulary.pickle', 'wb') as g:
-        pickle.dump(vocabulary, g)
+        pickle.dump(vocabulary, g, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def encode_plot(preprocessed_plot, vocabulary, idx, cwd):
@@ -132,7 +140,7 @@ def encode_plot(preprocessed_plot, vocabulary, idx, cwd):
     
     # store in pickle
     with open(cwd+encoded_plots_folder+str(idx)+".pickle", "wb") as h:
-        pickle.dump(dict_repr, h)
+        pickle.dump(dict_repr, h, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 if __name__ == "__main__":